@@ -6,27 +6,43 @@ import argparse
 import json
 import time
 
+import numpy as np
 from termcolor import colored, cprint
 from scipy.stats import mannwhitneyu
 
+# orjson is optional; it's just a faster parser for the same JSON files.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 DEFAULT_P_TARGET = 0.01
 
+# scipy's own default: exact for small samples without ties, else asymptotic.
+DEFAULT_METHOD = 'auto'
+
+
+def load_data(path):
+    """Load a JSON list of results, as written by run_test.py."""
+    with(open(path, 'rb') as f):
+        if orjson is not None:
+            return orjson.loads(f.read())
+        return json.load(f)
+
 
 def run_compare(args):
     start_time = time.time()
 
-    with(open(args.one, 'r') as f1):
-        d1 = json.load(f1)
-    with(open(args.two, 'r') as f2):
-        d2 = json.load(f2)
+    d1 = load_data(args.one)
+    d2 = load_data(args.two)
     assert(len(d1) == len(d2))
 
     if args.show_data:
         print("%s:\n %s" % (args.one, d1))
         print("%s:\n %s" % (args.two, d2))
 
-    results = mannwhitneyu(d1, d2)
+    results = mannwhitneyu(np.asarray(d1), np.asarray(d2), method=args.method, alternative='two-sided')
     pvalue = results.pvalue
     if pvalue < args.p_target:
         # If pvalue is lower, we have more confidence than necessary.
@@ -42,6 +58,7 @@ if __name__ == "__main__":
     parser.add_argument('--show_data', help="Print out data", action='store_true')
     parser.add_argument('--verbose', help="Use more-verbose debug output", action='store_true')
     parser.add_argument('--p_target', help="Target p-value at which to declare victory", default=DEFAULT_P_TARGET)
+    parser.add_argument('--method', help="How to compute the p-value", choices=['asymptotic', 'exact', 'auto'], default=DEFAULT_METHOD)
     args = parser.parse_args()
 
     run_compare(args)
\ No newline at end of file
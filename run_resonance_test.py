@@ -25,9 +25,12 @@
 # See https://www.klipper3d.org/Measuring_Resonances.html for more about this.
 
 import argparse
+import concurrent.futures
+import glob
 import os
 import requests
 import subprocess
+from requests.adapters import HTTPAdapter
 import time
 
 # See https://github.com/Arksine/moonraker/blob/master/docs/web_api.md
@@ -39,6 +42,10 @@ DEFAULT_AXES = ["x", "y"]
 # one minute, even with this value set to exceed one minute.
 READ_TIMEOUT=180
 
+# Reuse one keep-alive connection to Moonraker for every command.
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
 # Determined empirically by watching /tmp/moonraker.conf, then adding a few
 # seconds.  If insufficient, you'll just get a hang.
 AFTER_TIMEOUT_WAIT_FOR_RESONANCE_TEST_S = 91.0
@@ -48,7 +55,8 @@ def run_gcode(printer, gcode):
     """Run a gcode command to completion and return the result.
     https://github.com/Arksine/moonraker/blob/master/docs/web_api.md#run-a-gcode
     """
-    r = requests.post("http://" + args.printer + "/printer/gcode/script?script=" + gcode, timeout=(1, READ_TIMEOUT))
+    # Let requests build and encode the query string, so spaces and '=' survive.
+    r = SESSION.post("http://" + printer + "/printer/gcode/script", params={"script": gcode}, timeout=(1, READ_TIMEOUT))
     #print(r.status_code)
     # Disabled for now to workaround 60-second presumably-Moonraker timeout
     #assert(r.status_code == 200)
@@ -75,8 +83,9 @@ assert os.path.exists(klipper_scripts_path)
 if not args.no_clear:
     print("Clearing remote .csv files.")
     # https://www.tutorialspoint.com/How-to-copy-a-file-to-a-remote-server-in-Python-using-SCP-or-SSH
-    p = subprocess.Popen(["ssh", args.username + "@" + args.printer, "rm", "/tmp/*.csv"])
-    sts = os.waitpid(p.pid, 0)
+    # posix_spawn skips the fork() copy of this process that Popen would make.
+    pid = os.posix_spawnp("ssh", ["ssh", args.username + "@" + args.printer, "rm", "/tmp/*.csv"], os.environ)
+    sts = os.waitpid(pid, 0)
 
 if not args.no_testing:
     print("Homing printer.")
@@ -98,18 +107,26 @@ if not args.no_processing:
 
     print("Copying files")
     # https://www.tutorialspoint.com/How-to-copy-a-file-to-a-remote-server-in-Python-using-SCP-or-SSH
-    p = subprocess.Popen(["scp", args.username + "@" + args.printer + ":/tmp/*.csv", args.testname])
-    sts = os.waitpid(p.pid, 0)
+    pid = os.posix_spawnp("scp", ["scp", args.username + "@" + args.printer + ":/tmp/*.csv", args.testname], os.environ)
+    sts = os.waitpid(pid, 0)
 
     print("Running processing scripts")
+    # Globs are expanded here, since the scripts are run without a shell.
+    commands = []
     for axis in args.axes:
-        subprocess.check_output("python3 {klipper_scripts_path}/graph_accelerometer.py" \
-            " {testname}/raw_data_{axis}_*.csv -a {axis} -o {testname}/{axis}_raw_{testname}.png" \
-            .format(klipper_scripts_path = klipper_scripts_path, testname = args.testname, axis = axis), stderr=subprocess.STDOUT, shell=True)
-
-        subprocess.check_output("python3 {klipper_scripts_path}/calibrate_shaper.py" \
-            " {testname}/raw_data_{axis}*.csv -o {testname}/calibrate_{axis}_{testname}.png" \
-            .format(klipper_scripts_path = klipper_scripts_path, testname = args.testname, axis = axis), stderr=subprocess.STDOUT, shell=True)
+        commands.append(["python3", os.path.join(klipper_scripts_path, "graph_accelerometer.py")] \
+            + sorted(glob.glob("{testname}/raw_data_{axis}_*.csv".format(testname = args.testname, axis = axis))) \
+            + ["-a", axis, "-o", "{testname}/{axis}_raw_{testname}.png".format(testname = args.testname, axis = axis)])
+
+        commands.append(["python3", os.path.join(klipper_scripts_path, "calibrate_shaper.py")] \
+            + sorted(glob.glob("{testname}/raw_data_{axis}*.csv".format(testname = args.testname, axis = axis))) \
+            + ["-o", "{testname}/calibrate_{axis}_{testname}.png".format(testname = args.testname, axis = axis)])
+
+    # Each script is independent and CPU-bound, so run them all at once.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        futures = [executor.submit(subprocess.check_output, command, stderr=subprocess.STDOUT) for command in commands]
+        for future in futures:
+            future.result()
 
 print("Test completed.")
 print("To view files, run:\n\topen " + args.testname + "/*.png")
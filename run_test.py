@@ -4,16 +4,42 @@
 #   ./run_test.py -h
 
 import argparse
+import functools
 import json
 import os
-import pprint
 import statistics
 import random
 import re
 import sys
 import time
-
-import requests
+import urllib.parse
+
+import urllib3
+
+# orjson is optional; fall back to the stdlib json module when it's missing.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# numpy is optional; when present, it computes medians and the summary stats.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# ijson is optional; when present, gcode_store responses are parsed as a stream.
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# pysimdjson is optional; when present, gcode_store entries are decoded lazily,
+# so only the fields that get read become Python objects.
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
 
 # Moonraker API
 # https://moonraker.readthedocs.io/en/latest/web_api/#json-rpc-api-overview
@@ -32,16 +58,19 @@ DEFAULT_ITERATIONS = 1
 DEFAULT_OUTPUT_PATH = "results.json"
 
 # Text used to indicate in the console the beginning of this script's execution.
+# Each iteration appends a run ID and its iteration number.
 MARKER_MESSAGE_GCODE = "M117 Running Test"
 
 # Range in which to select random motions for each test.
 Z_TILT_ADJUST_MOVED_RANDOMIZED_RANGE = (2, 7)
 
-# Gap between tests; tries to avoid an apparent race condition where a just-written
+# Max wait between tests; avoids an apparent race condition where a just-written
 # log entry (created by an M117 message) is not made visible to the next call to
-# get cached responses.
+# get cached responses.  The cache is polled at MARKER_POLL_INTERVAL until the
+# entry shows up, so this is only the worst case.
 # Was 1.0!
 AFTER_MARKER_GAP = 0.5
+MARKER_POLL_INTERVAL = 0.05
 
 # Change these to match your printer, for sure.
 START_GCODES = ["G28"]
@@ -67,43 +96,80 @@ MICROSTEP_XY_SIZE = 0.003125
 
 
 
+def json_default(obj):
+    """Convert lazily-decoded simdjson entries for print_json()."""
+    if simdjson is not None and isinstance(obj, simdjson.Object):
+        return obj.as_dict()
+    raise TypeError("Cannot serialize %r" % (obj,))
+
+def print_json(obj):
+    """Pretty-print a message list or response, for verbose output."""
+    if orjson is not None:
+        # Write orjson's bytes straight to stdout, skipping the decode to str.
+        # Flush first so this lands after anything already print()ed.
+        sys.stdout.flush()
+        sys.stdout.buffer.write(orjson.dumps(obj, default=json_default, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+    else:
+        print(json.dumps(obj, default=json_default, indent=2))
+
+
+# Each PROCESSING_FCN_* filters and extracts in a single pass over the message
+# text, looking up each entry's "message" only once; the filtered list is only
+# built when it's needed for verbose output.
+
+def message_texts(messages):
+    """Return a generator over the text of each gcode_store entry."""
+    return (m["message"] for m in messages)
+
+
+# Sample message:
+# {'message': '// probe accuracy results: maximum 11.995491, '
+#             'minimum 11.992991, range 0.002500, average '
+#             '11.994658, median 11.995491, standard deviation '
+#             '0.001179',
+
+RANGE_RE = re.compile(r'range (\d+\.\d+)')
+
+def extract_range(input):
+    return float(RANGE_RE.search(input).group(1))
+
+
 def PROCESSING_FCN_PROBE_ACCURACY(messages, verbose):
-    # Sample message:
-    # {'message': '// probe accuracy results: maximum 11.995491, '
-    #             'minimum 11.992991, range 0.002500, average '
-    #             '11.994658, median 11.995491, standard deviation '
-    #             '0.001179',
-    def extract_range(input):
-        return float(input.split(',')[2].split('range ')[1])
-
-    probe_messages = [m for m in messages if "probe accuracy results" in m["message"]]
+    probe_messages = (msg for msg in message_texts(messages) if "probe accuracy results" in msg)
     if verbose:
+        probe_messages = list(probe_messages)
         print("Probe messages:")
-        pprint.pprint(probe_messages)
+        print_json(probe_messages)
 
-    values = [extract_range(m["message"]) for m in probe_messages]
+    values = [extract_range(m) for m in probe_messages]
+    assert values, "No probe accuracy results found"
+    if np is not None:
+        return float(np.median(np.asarray(values, dtype=np.float64)))
     return statistics.median(values)
 
 
+# Sample message:
+# {'message': '// Retries: 0/3 Probed points range: 0.005000 '
+#             'tolerance: 0.010000',
+#  'time': 1645515774.3865793,
+#  'type': 'response'},
+
+RETRIES_RE = re.compile(r'Retries:\s*(\d+)/')
+
+def extract_retries(input):
+    return int(RETRIES_RE.search(input).group(1))
+
+
 def PROCESSING_FCN_Z_TILT_ADJUST(messages, verbose):
-    # Sample message:
-    # {'message': '// Retries: 0/3 Probed points range: 0.005000 '
-    #             'tolerance: 0.010000',
-    #  'time': 1645515774.3865793,
-    #  'type': 'response'},
-    def extract_retries(input):
-        return int(input.split('Retries:')[1].split('/')[0].strip()[0])
-
-    probe_messages = [m for m in messages if "Retries" in m["message"]]
     if verbose:
         print("Probe messages:")
-        pprint.pprint(probe_messages)
+        print_json([msg for msg in message_texts(messages) if "Retries" in msg])
 
-    # Get a list of retries.  The last-seen retry message indicates the actual
-    # number of retries.
-    retries = [extract_retries(m["message"]) for m in probe_messages]
-    num_retries = retries[-1]
-    return num_retries
+    # The last-seen retry message indicates the actual number of retries, so
+    # scan from the end and stop at the first one.
+    last_message = next((msg for msg in message_texts(reversed(messages)) if "Retries" in msg), None)
+    assert last_message is not None, "No Retries messages found"
+    return extract_retries(last_message)
 
 
 # GET_Z_OFFSET is a macro useful for IDEX printers with a common Z nozzle endstop:
@@ -121,15 +187,18 @@ def PROCESSING_FCN_Z_TILT_ADJUST(messages, verbose):
 # Sample message:
 # mcu: dual_carriage:-1 stepper_y:102 stepper_y1:80 stepper_z:-11329 stepper_z1:-11329 stepper_z2:-11329 stepper_x:-8
 
+Z_POSITION_RE = re.compile(r'stepper_z:(-?\d+)')
+
 def extract_z_position(input):
-    return int(input.split('stepper_z:')[1].split(' ')[0])
+    return int(Z_POSITION_RE.search(input).group(1))
 
 
 def PROCESSING_FCN_GET_Z_OFFSET(messages, verbose):
-    position_messages = [m["message"] for m in messages if "mcu: " in m["message"]]
+    position_messages = (msg for msg in message_texts(messages) if "mcu: " in msg)
     if verbose:
+        position_messages = list(position_messages)
         print("Position messages:")
-        pprint.pprint(position_messages)
+        print_json(position_messages)
 
     z_positions = [extract_z_position(m) for m in position_messages]
     assert len(z_positions) == 2
@@ -138,10 +207,11 @@ def PROCESSING_FCN_GET_Z_OFFSET(messages, verbose):
 
 
 def PROCESSING_FCN_Z_POSITION(messages, verbose):
-    position_messages = [m["message"] for m in messages if "mcu: " in m["message"]]
+    position_messages = (msg for msg in message_texts(messages) if "mcu: " in msg)
     if verbose:
+        position_messages = list(position_messages)
         print("Position messages:")
-        pprint.pprint(position_messages)
+        print_json(position_messages)
 
     z_positions = [extract_z_position(m) for m in position_messages]
     assert len(z_positions) == 1
@@ -149,21 +219,22 @@ def PROCESSING_FCN_Z_POSITION(messages, verbose):
     return z_diff_mm
 
 
-def extract_int_val(s, key):
-    return int(re.search(key + ":([-+]?\\d+)", s).group(1))
-
-
 POSITION_KEYS = ['x', 'y', 'z']
 
+# One pattern per stepper, compiled once.  GET_POSITION replies span several
+# lines; the first match is the "mcu:" step count, later ones are floats.
+STEPPER_POSITION_RES = {k: re.compile('stepper_' + k + r':([-+]?\d+)') for k in POSITION_KEYS}
+
 def parse_position_message(m, keys):
-    return {k:extract_int_val(m, 'stepper_' + k) for k in keys}
+    return {k:int(STEPPER_POSITION_RES[k].search(m).group(1)) for k in keys}
 
 
 def PROCESSING_FCN_HOME_POSITION(messages, verbose):
-    position_messages = [m["message"] for m in messages if "mcu: " in m["message"]]
+    position_messages = (msg for msg in message_texts(messages) if "mcu: " in msg)
     if verbose:
+        position_messages = list(position_messages)
         print("Position messages:")
-        pprint.pprint(position_messages)
+        print_json(position_messages)
 
     positions = [parse_position_message(m, POSITION_KEYS) for m in position_messages]
     assert len(positions) == 1
@@ -186,10 +257,11 @@ def parse_tool_locate_sensor_message(m):
     }
 
 def PROCESSING_FCN_TOOL_LOCATE_SENSOR(messages, verbose):
-    tool_locate_messages = [m["message"] for m in messages if "Sensor location at" in m["message"]]
+    tool_locate_messages = (msg for msg in message_texts(messages) if "Sensor location at" in msg)
     if verbose:
+        tool_locate_messages = list(tool_locate_messages)
         print("Tool locate messages:")
-        pprint.pprint(tool_locate_messages)
+        print_json(tool_locate_messages)
 
     positions = [parse_tool_locate_sensor_message(m) for m in tool_locate_messages]
     assert len(positions) == 1
@@ -212,10 +284,11 @@ def parse_offset_message(m):
     }
 
 def PROCESSING_FCN_OFFSET_CALC(messages, verbose):
-    offset_messages = [m["message"] for m in messages if "Tool offset is" in m["message"]]
+    offset_messages = (msg for msg in message_texts(messages) if "Tool offset is" in msg)
     if verbose:
+        offset_messages = list(offset_messages)
         print("Offset messages:")
-        pprint.pprint(offset_messages)
+        print_json(offset_messages)
 
     positions = [parse_offset_message(m) for m in offset_messages]
     assert len(positions) == 1
@@ -298,7 +371,7 @@ COMMANDS = {
     },
     # QUAD_GANTRY_LEVEL with no intentional out-of-flat change in between.
     'qgl': {
-        'commands_fcn': lambda args: "QUAD_GANTRY_LEVEL",
+        'commands_fcn': lambda args: ["QUAD_GANTRY_LEVEL"],
         # Same as above, plus others for our commands.
         'messages_per_command': 200,
         'processing_fcn': PROCESSING_FCN_Z_TILT_ADJUST,
@@ -367,29 +440,99 @@ COMMANDS = {
 }
 
 
-def run_gcode(printer, gcode, verbose=False):
+@functools.lru_cache(maxsize=64)
+def encode_script(gcode):
+    """Return the encoded query string for a gcode script.
+    The test command scripts repeat every iteration, so each is only encoded
+    once; one-off scripts like markers should skip this cache.
+    """
+    return urllib.parse.urlencode({"script": gcode})
+
+# Timeouts for each Moonraker request.
+TIMEOUT = urllib3.Timeout(connect=1, read=READ_TIMEOUT)
+
+def make_http():
+    """Create a urllib3 pool that reuses keep-alive connections to Moonraker,
+    rather than reconnecting for each command and cache fetch.
+    urllib3 is what requests wraps; using it directly skips requests' per-call
+    request preparation, redirect handling and hooks.
+    """
+    # Never retry: a retried POST could run a gcode script twice.
+    return urllib3.PoolManager(num_pools=1, maxsize=4, retries=False)
+
+def run_gcode(http, printer, gcode, verbose=False, cache=True):
     """Run a gcode command to completion and return the result.
+    A list of commands is sent as a single multi-line script, in one request.
+    Pass cache=False for scripts that never repeat.
     https://github.com/Arksine/moonraker/blob/master/docs/web_api.md#run-a-gcode
     """
-    r = requests.post("http://" + printer + "/printer/gcode/script?script=" + gcode, timeout=(1, READ_TIMEOUT))
+    if not isinstance(gcode, str):
+        gcode = "\n".join(gcode)
+    # Encode the query string ourselves, so spaces, '=' and newlines survive.
+    query = encode_script(gcode) if cache else urllib.parse.urlencode({"script": gcode})
+    r = http.request("POST", "http://" + printer + "/printer/gcode/script?" + query, timeout=TIMEOUT)
     if verbose:
-        print(r.status_code)
+        print(r.status)
     # Disabled for now to workaround 60-second presumably-Moonraker timeout
-    #assert(r.status_code == 200)
+    #assert(r.status == 200)
     return r
 
-def get_cached_gcode(printer, count, verbose=False):
+def get_cached_gcode(http, printer, count, verbose=False):
     """Get cached gcode, up to the amount specified.
     https://moonraker.readthedocs.io/en/latest/web_api/#http-api-overview
     GET /server/gcode_store?count=100
     """
-    r = requests.get("http://" + printer + ("/server/gcode_store?count=%s" % count), timeout=(1, READ_TIMEOUT))
+    r = http.request("GET", "http://" + printer + "/server/gcode_store", fields={"count": count}, timeout=TIMEOUT, preload_content=False)
     if verbose:
-        print(r.status_code)
+        print(r.status)
     # Disabled for now to workaround 60-second presumably-Moonraker timeout
-    #assert(r.status_code == 200)
+    #assert(r.status == 200)
     return r
 
+def iter_gcode_store(r):
+    """Yield each entry of a get_cached_gcode() response, in order.
+    With pysimdjson installed, entries are lazy views whose fields are decoded on
+    access; with ijson, entries are parsed one at a time from the response body;
+    otherwise the whole body is decoded with orjson, or json as a last resort.
+    """
+    try:
+        if simdjson is not None:
+            # A parser holds one document at a time, and entries outlive this call.
+            yield from simdjson.Parser().parse(r.data)["result"]["gcode_store"]
+        elif ijson is not None:
+            yield from ijson.items(r, "result.gcode_store.item", use_float=True)
+        else:
+            # Decode straight from the body bytes, never building a str of it.
+            loads = orjson.loads if orjson is not None else json.loads
+            yield from loads(r.data)["result"]["gcode_store"]
+    finally:
+        # Streamed responses hold their connection until it's read out and released.
+        r.drain_conn()
+        r.release_conn()
+
+def get_cached_gcode_since(http, printer, since, count, verbose=False):
+    """Get the cached gcode logged after the printer-side time `since`, looking
+    back at most `count` entries.
+    Moonraker's gcode_store only takes a count, so entries are filtered here as
+    they're parsed.  Returns None if every fetched entry is newer than `since`,
+    since earlier messages may then have been missed.
+    """
+    entries = iter_gcode_store(get_cached_gcode(http, printer, count))
+    if verbose:
+        all_entries = list(entries)
+        print_json(all_entries)
+        entries = iter(all_entries)
+
+    # Moonraker's timestamps only increase, so everything past the first newer entry is wanted.
+    found_since = False
+    for entry in entries:
+        if entry["time"] > since:
+            if not found_since:
+                return None
+            return [entry] + list(entries)
+        found_since = True
+    return [] if found_since else None
+
 
 class KlipperTest:
 
@@ -401,6 +544,7 @@ class KlipperTest:
         self.processing_fcn = processing_fcn
         self.messages_per_command = messages_per_command
         self.args = args
+        self.http = make_http()
 
         if kwargs.get("start_gcodes") != None:
             self.start_gcodes = json.loads(kwargs.get("start_gcodes"))
@@ -411,89 +555,103 @@ class KlipperTest:
         else:
             self.end_gcodes = END_GCODES
 
-        self.marker_message = None
+        # Tags this run's markers, so a marker left over from an earlier run
+        # is never mistaken for ours.
+        self.run_id = "%04x" % random.getrandbits(16)
+
         self.results = None  # List of results value (single floats)
 
-    def _get_marker_message(self):
+    def _get_marker_message(self, iteration):
         """Send a dummy message, which can be used in future log-scraping.
 
-        Returns the marker message.
+        Returns the printer-side time of the marker message; everything logged
+        after it belongs to this iteration.
         """
         # Get time from the printer, to use with rejecting earlier cached gcode
-        run_gcode(self.printer, MARKER_MESSAGE_GCODE)
+        marker = "%s %s-%d" % (MARKER_MESSAGE_GCODE, self.run_id, iteration)
+        # Every marker is unique, so don't let it fill the encoding cache.
+        run_gcode(self.http, self.printer, marker, cache=False)
 
-        # Hacky wait time.
-        time.sleep(AFTER_MARKER_GAP)
+        # Messages look like this:
+        # [{'message': 'M117 Hello',
+        #   'time': 1645515805.776437,
+        #   'type': 'command'}]
+        # Poll until our marker shows up, rather than always waiting the full gap.
+        deadline = time.monotonic() + AFTER_MARKER_GAP
+        while True:
+            result = get_cached_gcode(self.http, self.printer, 2)
+            entries = list(iter_gcode_store(result))
+            entry = next((e for e in reversed(entries) if e["message"] == marker and e["type"] == "command"), None)
+            if entry is not None or time.monotonic() >= deadline:
+                break
+            time.sleep(MARKER_POLL_INTERVAL)
 
-        result = get_cached_gcode(self.printer, 2)
-        result_json = result.json()["result"]
         if self.verbose:
-            pprint.pprint(result_json)
+            print_json(entries)
 
-        # Messages look like this:
-        # {'gcode_store': [{'message': 'M117 Hello',
-        #                  'time': 1645515805.776437,
-        #                  'type': 'command'}]}
-        entry = result_json["gcode_store"][-1]
-        assert entry["message"] == MARKER_MESSAGE_GCODE, "Expected %s but got %s, from %s" % (MARKER_MESSAGE_GCODE, entry["message"], result_json)
-        assert entry["type"] == "command"
-        return entry
+        assert entry is not None, "Expected %s, from %s" % (marker, entries)
+        return entry["time"]
 
     def run(self):
-        for gcode in self.start_gcodes:
-            run_gcode(self.printer, gcode)
-        self.results = []
-        for i in range(self.iterations):
-            # Attempt to clear the cache somehow.
-            result = get_cached_gcode(self.printer, self.messages_per_command)
-
-            # Then, send our message.
-            self.marker_message = self._get_marker_message()
-            commands = self.commands_fcn(self.args)
-            for command in commands:
-                run_gcode(self.printer, command)
-
-            result = get_cached_gcode(self.printer, self.messages_per_command)
-            result_json = result.json()["result"]
-            if self.verbose:
-                pprint.pprint(result_json)
-
-            messages = result_json["gcode_store"]
-
-            # Ensure that we collected enough messages to see the original, first message.
-            if self.marker_message not in messages:
-                print("Unable to find original message in collected list; increase messages_per_command"
-                        "from %s and try again." % self.messages_per_command)
-                sys.exit(1)
-
-            message_index = messages.index(self.marker_message)
-            if self.verbose:
-                print("Found original message at index %s" % message_index)
-            messages_filtered = result_json["gcode_store"][message_index + 1:]
-            if self.verbose:
-                print("Filtered messages:")
-                pprint.pprint(messages_filtered)
-
-            result = self.processing_fcn(messages_filtered, self.verbose)
-            print("> Result: %s" % result)
-            self.results.append(result)
-
-        for gcode in self.end_gcodes:
-            run_gcode(self.printer, gcode)
+        # Keep connections open from the start gcodes to the end gcodes,
+        # then release them.
+        try:
+            self._run()
+        finally:
+            self.http.clear()
+
+    def _run(self):
+        if self.start_gcodes:
+            run_gcode(self.http, self.printer, self.start_gcodes)
+
+        self.results = [self._run_one_iteration(i) for i in range(self.iterations)]
+
+        if self.end_gcodes:
+            run_gcode(self.http, self.printer, self.end_gcodes)
+
+    def _run_one_iteration(self, iteration):
+        """Run the test commands once, and return the processed result."""
+        # Send our message.
+        marker_time = self._get_marker_message(iteration)
+        commands = self.commands_fcn(self.args)
+        assert isinstance(commands, list), "commands_fcn must return a list, not %r" % (commands,)
+        run_gcode(self.http, self.printer, commands)
+
+        # Keep only the messages after our marker.
+        messages_filtered = get_cached_gcode_since(self.http, self.printer, marker_time, self.messages_per_command, self.verbose)
+
+        # Ensure that we collected enough messages to see the original, first message.
+        if messages_filtered is None:
+            print("Unable to find original message in collected list; increase messages_per_command"
+                    "from %s and try again." % self.messages_per_command)
+            sys.exit(1)
+
+        if self.verbose:
+            print("Filtered messages:")
+            print_json(messages_filtered)
 
+        result = self.processing_fcn(messages_filtered, self.verbose)
+        print("> Result: %s" % result)
+        return result
 
     def get_results(self):
         return self.results
 
 
 def print_stats(data):
-    median = statistics.median(data)
-    print("  Range: %0.4f" % (max(data) - min(data)))
-    print("  Min: %0.4f" % min(data))
-    print("  Max: %0.4f" % max(data))
+    # Compute each stat once, up front.
+    if np is not None:
+        arr = np.asarray(data, dtype=np.float64)
+        min_val, max_val, median = arr.min(), arr.max(), np.median(arr)
+        s = arr.std(ddof=1) if len(arr) > 1 else None
+    else:
+        min_val, max_val, median = min(data), max(data), statistics.median(data)
+        s = statistics.stdev(data) if len(data) > 1 else None
+    print("  Range: %0.4f" % (max_val - min_val))
+    print("  Min: %0.4f" % min_val)
+    print("  Max: %0.4f" % max_val)
     print("  Median: %0.4f" % median)
-    if len(data) > 1:
-        s = statistics.stdev(data)
+    if s is not None:
         print("  Standard Deviation: %0.4f" % s)
 
 def run_test(args):
@@ -541,8 +699,11 @@ def run_test(args):
     print("--- %0.2f seconds total; %0.2f per iteration ---" % (total_time, time_per_iteration))
 
     if args.output:
-        with(open(args.output_path, 'w') as outfile):
-            json.dump(data, outfile)
+        with(open(args.output_path, 'wb') as outfile):
+            if orjson is not None:
+                outfile.write(orjson.dumps(data))
+            else:
+                outfile.write(json.dumps(data).encode())
 
 
 if __name__ == "__main__":